@@ -1,16 +1,54 @@
+import re
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+
+import jinja2
+import numpy as np
+
+
+@dataclass(frozen=True)
+class UnpackPattern:
+    """A 12 byte unpack pattern: the source byte of each output, the shift
+    each output needs, the name used for the generated bindings, and the
+    shift direction."""
+
+    perm: tuple[int, ...]
+    shift: tuple[int, ...]
+    name: str
+    shift_right: bool = False
+
+
+def _materialize(
+    pattern: list[int], repeat: int, increase: bool = False
+) -> np.ndarray:
+    """Repeats the pattern into a single array, increasing the indices by 8
+    each time, unless the value is 0x80, if increase is True."""
+    tiled = np.tile(np.asarray(pattern, dtype=np.int16), (repeat, 1))
+    if increase:
+        offsets = (np.arange(repeat, dtype=np.int16) * 8).reshape(-1, 1)
+        tiled = np.where(tiled == 0x80, 0x80, tiled + offsets)
+    return tiled.ravel()
+
+
 def repeat_pattern(
     pattern: list[int], repeat: int, increase: bool = False
 ) -> list[int]:
     """Repeats the pattern, but increasing the indices by 8 each time, unless
     the value is 0x80, if increase is True."""
-    result = []
-    for i in range(repeat):
-        for j in range(len(pattern)):
-            if pattern[j] == 0x80:
-                result.append(0x80)
-            else:
-                result.append(pattern[j] + (8 * i if increase else 0))
-    return result
+    return _materialize(pattern, repeat, increase).tolist()
+
+
+def _pack(pattern: np.ndarray, size: int = 1, replace: bool = True) -> np.ndarray:
+    """Zero extend an array of bytes to size bytes (where size is a power of 2)
+    and then reinterpret as an array of 64 bit integers. Replaces 0x80 with 0
+    when replace is True."""
+    assert len(pattern) % 8 == 0
+
+    arr = np.asarray(pattern)
+    if replace:
+        arr = np.where(arr == 0x80, 0, arr)
+    return arr.astype(f"<u{size}").view("<u8")
 
 
 def intify_pattern(
@@ -19,87 +57,374 @@ def intify_pattern(
     """Zero extend a list of bytes to size bytes (where size is a power of 2)
     and then convert to a list of 64 bit integers. Replaces 0x80 with 0 when
     replace is True."""
-    assert len(pattern) % 8 == 0
-
-    bytes_per_result = 8 // size
-    results = []
-    for i in range(0, len(pattern), bytes_per_result):
-        result = 0
-        for j in range(0, 8, size):
-            pattern_byte = pattern[i + j // size]
-            pattern_byte = 0 if pattern_byte == 0x80 and replace else pattern_byte
-            result |= pattern_byte << (j * 8)
-        results.append(result)
-    return results
+    return _pack(np.asarray(pattern, dtype=np.uint8), size, replace).tolist()
 
 
-def hexlist_ints(ints: list[int], reverse: bool = True) -> str:
-    """Converts a list of 64 bit integers to a string of hex values, reversing
-    the order if reverse is True."""
-    ints = ints[::-1] if reverse else ints
-    return ", ".join([f"0x{x:016x}" for x in ints])
+def hexlist_ints(ints: np.ndarray, reverse: bool = True) -> str:
+    """Converts an array of 64 bit integers to a string of hex values,
+    reversing the order if reverse is True."""
+    return ", ".join(map("0x{:016x}".format, reversed(ints) if reverse else ints))
 
 
 def generate_mask(pattern: list[int]) -> int:
     """Generates a mask for the given patter, where 0x80 corresponds to a 0 bit
     and any other value corresponds to a 1 bit."""
-    mask = 0
-    for i in range(len(pattern)):
-        mask |= (pattern[i] != 0x80) << i
-    return mask
+    assert len(pattern) <= 64
 
+    bits = (np.asarray(pattern) != 0x80).astype(np.uint64)
+    return int((bits << np.arange(len(pattern), dtype=np.uint64)).sum())
 
-def shift_indices(pattern: list[int], shift: int) -> list[int]:
+
+def shift_indices(pattern: np.ndarray, shift: int) -> np.ndarray:
     """Shifts the indices in the pattern by the given amount, but preserves
     0x80."""
-    return [x + shift if x != 0x80 else x for x in pattern]
+    pattern = np.asarray(pattern)
+    return np.where(pattern == 0x80, pattern, pattern + shift)
 
 
-def generate_intrinsics_avx512(
+def format_static(name: str, values: tuple[int, ...], bits: int) -> str:
+    """Formats a constant table as an aligned static array, in memory order
+    (lowest qword first), suitable for an aligned vector load."""
+    hexes = ", ".join(f"0x{x:016x}" for x in values)
+    return f"static {name}: Align{bits // 8} = Align{bits // 8}([{hexes}]);"
+
+
+def dedupe_statics(
+    statics: list[tuple[str, tuple[int, ...], int]], lines: list[str]
+) -> tuple[list[str], list[str]]:
+    """Deduplicates constant tables by value, emitting one aligned static per
+    distinct table and rewriting loads of dropped duplicates to use the first
+    copy. Returns the static declarations and the rewritten lines."""
+    decls = []
+    for bits in sorted({bits for _, _, bits in statics}, reverse=True):
+        decls.append(f"#[repr(align({bits // 8}))]")
+        decls.append(f"struct Align{bits // 8}([u64; {bits // 64}]);")
+
+    seen: dict[tuple[int, ...], str] = {}
+    for name, values, bits in statics:
+        canonical = seen.setdefault((bits, *values), name)
+        if canonical == name:
+            decls.append(format_static(name, values, bits))
+        else:
+            lines = [line.replace(name, canonical) for line in lines]
+    return decls, lines
+
+
+def _register_load(
+    statics: list[tuple[str, tuple[int, ...], int]],
+    setup: list[str],
+    binding: str,
+    values: np.ndarray,
+    bits: int,
+) -> None:
+    """Registers a constant table as a static for format_static and appends
+    the aligned load that binds it in the generated function."""
+    static_name = binding.upper()
+    statics.append((static_name, tuple(values.tolist()), bits))
+    prefix = {512: "_mm512", 256: "_mm256", 128: "_mm"}[bits]
+    setup.append(
+        f"let {binding} = {prefix}_load_si{bits}({static_name}.0.as_ptr() as *const __m{bits}i);"
+    )
+
+
+def dedupe_bindings(lines: list[str]) -> list[str]:
+    """Rewrites later bindings whose right hand side matches an earlier one
+    into aliases of the first binding, so value-identical constants are only
+    materialized once. Only immutable `let name = expr;` lines are
+    considered, which the intrinsics being pure makes safe."""
+    seen: dict[str, str] = {}
+    result = []
+    for line in lines:
+        match = re.fullmatch(r"let (\w+) = (.+);", line)
+        if match is None:
+            result.append(line)
+            continue
+        name, expr = match.groups()
+        canonical = seen.setdefault(expr, name)
+        result.append(line if canonical == name else f"let {name} = {canonical};")
+    return result
+
+
+def is_identity_pattern(pattern: np.ndarray) -> bool:
+    """Returns whether the pattern maps every slot to its own source byte
+    with nothing masked, in which case the source register can be used
+    directly and the permutation disappears."""
+    pattern = np.asarray(pattern)
+    return bool((pattern == np.arange(len(pattern))).all())
+
+
+def is_expand_pattern(pattern: np.ndarray) -> bool:
+    """Returns whether the pattern places source bytes 0, 1, 2, ... in order
+    into its non-0x80 slots, which is exactly the mapping VPEXPANDB performs
+    given the pattern's mask."""
+    pattern = np.asarray(pattern)
+    values = pattern[pattern != 0x80]
+    return bool((values == np.arange(len(values))).all())
+
+
+def uniform_shift(group: np.ndarray) -> int | None:
+    """Returns the single shift amount shared by the whole group, or None if
+    the group mixes amounts. A uniform group needs only a broadcast instead
+    of a constant table, and a uniform zero needs no shift at all."""
+    amounts = set(group.tolist())
+    return int(group[0]) if len(amounts) == 1 else None
+
+
+def build_multishift_ctrl(
+    perm_pattern: list[int], shift_pattern: list[int], shift_right: bool = True
+) -> list[int]:
+    """Builds the control bytes for VPMULTISHIFTQB from a permutation and
+    shift pattern. Each control byte is the bit offset of an 8 bit field
+    within the source qword: 8 * byte_index + shift for right shifts and
+    8 * byte_index - shift for left shifts, since left shifting by s is the
+    same as selecting the field that starts s bits earlier. Preserves 0x80."""
+    perm = np.asarray(perm_pattern, dtype=np.int16)
+    shift = np.asarray(shift_pattern, dtype=np.int16)
+    ctrl = perm * 8 + (shift if shift_right else -shift)
+    valid = ctrl[perm != 0x80]
+    assert ((valid >= 0) & (valid <= 56)).all()
+    return np.where(perm == 0x80, perm, ctrl).tolist()
+
+
+def generate_intrinsics_avx512_multishift(
+    perm_pattern: list[int],
+    shift_pattern: list[int],
+    name: str,
+    shift_right: bool = False,
+) -> list[str]:
+    """Generates the intrinsics for the given 12 byte pattern using AVX-512
+    VBMI VPMULTISHIFTQB. Each field is pulled straight out of its source
+    qword at bit granularity, so the permute, widen, and variable shift of
+    generate_intrinsics_avx512 collapse into one instruction per 64 output
+    bytes. Each group of 12 outputs is padded to 16 so both qwords of a group
+    read the same source qword, replicated by a qword permutation; the
+    emitted mask selects the 12 valid bytes per group."""
+    assert len(perm_pattern) == 12
+    assert len(shift_pattern) == 12
+
+    ctrl = build_multishift_ctrl(perm_pattern, shift_pattern, shift_right)
+    repeated_ctrl = _materialize(ctrl + [0x80] * 4, 8)
+    split_0, split_1 = repeated_ctrl[:64], repeated_ctrl[64:]
+    mask_0 = generate_mask(split_0)
+    mask_1 = generate_mask(split_1)
+    ctrl_0 = hexlist_ints(_pack(split_0))
+    ctrl_1 = hexlist_ints(_pack(split_1))
+
+    # Each 16 byte group reads one source qword, so replicate qwords 0..3
+    # into the first register and 4..7 into the second
+    qword_0 = ", ".join(str(x) for x in np.repeat(np.arange(4), 2)[::-1])
+    qword_1 = ", ".join(str(x) for x in np.repeat(np.arange(4, 8), 2)[::-1])
+
+    code = [
+        # Create the patterns for the qword replication and field offsets
+        f"let qword_{name}_0 = _mm512_set_epi64({qword_0});",
+        f"let qword_{name}_1 = _mm512_set_epi64({qword_1});",
+        f"let ctrl_{name}_0 = _mm512_set_epi64({ctrl_0});",
+        f"let ctrl_{name}_1 = _mm512_set_epi64({ctrl_1});",
+        # Extract the bit fields, code starting here goes inside the loop
+        f"let {name}_0 = _mm512_maskz_multishift_epi64_epi8(0x{mask_0:016x}, ctrl_{name}_0, _mm512_permutexvar_epi64(qword_{name}_0, longs));",
+        f"let {name}_1 = _mm512_maskz_multishift_epi64_epi8(0x{mask_1:016x}, ctrl_{name}_1, _mm512_permutexvar_epi64(qword_{name}_1, longs));",
+    ]
+
+    return code
+
+
+def generate_intrinsics_swar(
     perm_pattern: list[int],
     shift_pattern: list[int],
     name: str,
     shift_right: bool = False,
 ) -> list[str]:
-    """Generates the intrinsics for the given 12 byte pattern using AVX-512."""
+    """Generates a scalar fallback for the given 12 byte pattern that reads
+    each output's 8 bit field straight out of the source qword with a shift
+    and mask — the scalar analogue of the VPMULTISHIFTQB emitter, usable both
+    on machines without AVX2 and as a correctness oracle for the SIMD paths.
+    As there, a field's low bits come from the preceding byte, and 0x80 slots
+    produce zero."""
+    assert len(perm_pattern) == 12
+    assert len(shift_pattern) == 12
+
+    ctrl = build_multishift_ctrl(perm_pattern, shift_pattern, shift_right)
+    return [
+        f"let {name}_{i} = 0u16;"
+        if offset == 0x80
+        else f"let {name}_{i} = ((long >> {offset}) & 0xff) as u16;"
+        for i, offset in enumerate(ctrl)
+    ]
+
+
+def generate_intrinsics_avx512(
+    perm_pattern: list[int],
+    shift_pattern: list[int],
+    name: str,
+    shift_right: bool = False,
+) -> tuple[list[tuple[str, tuple[int, ...], int]], list[str], list[str]]:
+    """Generates the intrinsics for the given 12 byte pattern using AVX-512.
+    Returns the constant tables as (name, qwords, bits) tuples for
+    format_static, the in-function setup lines that load them, and the
+    per-loop body lines. Splits whose pattern takes source bytes in order are
+    expanded with VPEXPANDB instead of a permutation, which needs no index
+    constant. The generator is pure, so results are cached on the tuple form
+    of the patterns."""
+    return _gen_avx512(tuple(perm_pattern), tuple(shift_pattern), name, shift_right)
+
+
+@lru_cache(maxsize=None)
+def _gen_avx512(
+    perm_pattern: tuple[int, ...],
+    shift_pattern: tuple[int, ...],
+    name: str,
+    shift_right: bool,
+) -> tuple[list[tuple[str, tuple[int, ...], int]], list[str], list[str]]:
+    """Cached implementation of generate_intrinsics_avx512."""
     assert len(perm_pattern) == 12
     assert len(shift_pattern) == 12
 
-    repeated_perm = repeat_pattern(perm_pattern, 8, increase=True)
+    repeated_perm = _materialize(perm_pattern, 8, increase=True)
     split_32, split_64 = repeated_perm[:32], repeated_perm[32:]
     mask_32 = generate_mask(split_32)
     mask_64 = generate_mask(split_64)
-    intify_32 = hexlist_ints(intify_pattern(split_32))
-    intify_64 = hexlist_ints(intify_pattern(split_64))
 
-    repeated_shift = repeat_pattern(shift_pattern, 8)
-    shift_0 = hexlist_ints(intify_pattern(repeated_shift[:32], 2))
-    shift_1 = hexlist_ints(intify_pattern(repeated_shift[32:64], 2))
-    shift_2 = hexlist_ints(intify_pattern(repeated_shift[64:], 2))
+    repeated_shift = _materialize(shift_pattern, 8)
 
-    code = [
-        # Create the patterns for permutations
-        f"let perm_{name}_32 = _mm256_set_epi64x({intify_32});",
-        f"let perm_{name}_64 = _mm512_set_epi64({intify_64});",
-        # Create the patterns for shifts
-        f"let shift_{name}_0 = _mm512_set_epi64({shift_0});",
-        f"let shift_{name}_1 = _mm512_set_epi64({shift_1});",
-        f"let shift_{name}_2 = _mm512_set_epi64({shift_2});",
-        # Permute the values, code starting here goes inside the loop
-        f"let {name}_32 = _mm256_maskz_permutexvar_epi8(0x{mask_32:08x}, perm_{name}_32, _mm512_castsi512_si256(longs));",
-        f"let {name}_64 = _mm512_maskz_permutexvar_epi8(0x{mask_64:16x}, perm_{name}_64, longs);",
+    statics = []
+    setup = []
+    body = []
+
+    def load(binding: str, values: np.ndarray, bits: int) -> None:
+        _register_load(statics, setup, binding, values, bits)
+
+    # Permute the values, the body lines go inside the loop; longs_256 is the
+    # 256 bit view of longs bound once by emit_prologue
+    if is_identity_pattern(split_32):
+        body.append(f"let {name}_32 = longs_256;")
+    elif is_expand_pattern(split_32):
+        body.append(
+            f"let {name}_32 = _mm256_maskz_expand_epi8(0x{mask_32:08x}, longs_256);"
+        )
+    else:
+        load(f"perm_{name}_32", _pack(split_32), 256)
+        body.append(
+            f"let {name}_32 = _mm256_maskz_permutexvar_epi8(0x{mask_32:08x}, perm_{name}_32, longs_256);"
+        )
+    if is_identity_pattern(split_64):
+        body.append(f"let {name}_64 = longs;")
+    elif is_expand_pattern(split_64):
+        body.append(
+            f"let {name}_64 = _mm512_maskz_expand_epi8(0x{mask_64:016x}, longs);"
+        )
+    else:
+        load(f"perm_{name}_64", _pack(split_64), 512)
+        body.append(
+            f"let {name}_64 = _mm512_maskz_permutexvar_epi8(0x{mask_64:16x}, perm_{name}_64, longs);"
+        )
+
+    groups = [repeated_shift[:32], repeated_shift[32:64], repeated_shift[64:]]
+    # Registers whose whole group shifts by zero are never reassigned
+    muts = ["" if uniform_shift(g) == 0 else "mut " for g in groups]
+
+    body += [
         # Extend the 8 bit values to 16 bit values
-        f"let mut {name}_0 = _mm512_cvtepu8_epi16({name}_32);",
-        f"let mut {name}_1 = _mm512_cvtepu8_epi16(_mm512_castsi512_si256({name}_64));",
+        f"let {muts[0]}{name}_0 = _mm512_cvtepu8_epi16({name}_32);",
+        f"let {muts[1]}{name}_1 = _mm512_cvtepu8_epi16(_mm512_castsi512_si256({name}_64));",
         f"let {name}_64 = _mm512_extracti64x4_epi64({name}_64, 1);",
-        f"let mut {name}_2 = _mm512_cvtepu8_epi16({name}_64);",
-        # Shift the values
-        f"{name}_0 = _mm512_s{'r' if shift_right else 'l'}lv_epi16({name}_0, shift_{name}_0);",
-        f"{name}_1 = _mm512_s{'r' if shift_right else 'l'}lv_epi16({name}_1, shift_{name}_1);",
-        f"{name}_2 = _mm512_s{'r' if shift_right else 'l'}lv_epi16({name}_2, shift_{name}_2);",
+        f"let {muts[2]}{name}_2 = _mm512_cvtepu8_epi16({name}_64);",
     ]
 
-    return code
+    # Shift the values, dropping the constant and the shift for groups that
+    # shift by zero and broadcasting groups with a single shared amount
+    for i, group in enumerate(groups):
+        amount = uniform_shift(group)
+        if amount == 0:
+            continue
+        if amount is not None:
+            setup.append(f"let shift_{name}_{i} = _mm512_set1_epi16({amount});")
+        else:
+            load(f"shift_{name}_{i}", _pack(group, 2), 512)
+        body.append(
+            f"{name}_{i} = _mm512_s{'r' if shift_right else 'l'}lv_epi16({name}_{i}, shift_{name}_{i});"
+        )
+
+    return statics, setup, body
+
+
+def shift_matrix(shift: int, shift_right: bool = False) -> int:
+    """Builds the VGF2P8AFFINEQB matrix qword that shifts every byte of its
+    lane by the given amount. Bit i of the result is selected by matrix byte
+    7 - i, whose set bits pick the source bits to XOR, so a shift is the
+    identity matrix with its diagonal displaced."""
+    qword = 0
+    for i in range(8):
+        j = i + shift if shift_right else i - shift
+        if 0 <= j < 8:
+            qword |= (1 << j) << (8 * (7 - i))
+    return qword
+
+
+def generate_intrinsics_gfni(
+    perm_pattern: list[int],
+    shift_pattern: list[int],
+    name: str,
+    shift_right: bool = False,
+) -> tuple[list[str], list[str]]:
+    """Generates the intrinsics for the given 12 byte pattern using AVX-512
+    GFNI, where a single bit affine transform replaces the widen and
+    variable shift of the permuted bytes. VGF2P8AFFINEQB applies one 8x8 bit
+    matrix per qword, so every aligned group of 8 outputs must share one
+    shift, and the results stay 8 bits wide instead of being widened to 16."""
+    assert len(perm_pattern) == 12
+    assert len(shift_pattern) == 12
+
+    repeated_perm = _materialize(perm_pattern, 8, increase=True)
+    repeated_shift = _materialize(shift_pattern, 8)
+    lanes = repeated_shift.reshape(-1, 8)
+    # One matrix per output qword, so the shifts within each qword must agree
+    assert (lanes == lanes[:, :1]).all()
+
+    # Pad the trailing 32 outputs to a full register so both permutations can
+    # index all 64 source bytes
+    split_0 = repeated_perm[:64]
+    split_1 = np.concatenate((repeated_perm[64:], np.full(32, 0x80, np.int16)))
+    mask_0 = generate_mask(split_0)
+    mask_1 = generate_mask(split_1)
+
+    matrices = np.array(
+        [shift_matrix(int(s), shift_right) for s in lanes[:, 0]]
+        + [0] * 4,
+        dtype=np.uint64,
+    )
+
+    setup = [
+        # Create the patterns for permutations and the shift matrices
+        f"let perm_{name}_0 = _mm512_set_epi64({hexlist_ints(_pack(split_0))});",
+        f"let perm_{name}_1 = _mm512_set_epi64({hexlist_ints(_pack(split_1))});",
+        f"let m_{name}_0 = _mm512_set_epi64({hexlist_ints(matrices[:8])});",
+        f"let m_{name}_1 = _mm512_set_epi64({hexlist_ints(matrices[8:])});",
+    ]
+
+    body = [
+        # Permute the values, the body lines go inside the loop
+        f"let {name}_0 = _mm512_maskz_permutexvar_epi8(0x{mask_0:016x}, perm_{name}_0, longs);",
+        f"let {name}_1 = _mm512_maskz_permutexvar_epi8(0x{mask_1:016x}, perm_{name}_1, longs);",
+        # Shift the values with an affine transform per qword
+        f"let {name}_0 = _mm512_gf2p8affine_epi64_epi8({name}_0, m_{name}_0, 0);",
+        f"let {name}_1 = _mm512_gf2p8affine_epi64_epi8({name}_1, m_{name}_1, 0);",
+    ]
+
+    return setup, body
+
+
+def _packus_order(pattern: np.ndarray) -> np.ndarray:
+    """Reorders each 16 element group so that packus_epi32 of its widened
+    halves comes out in the group's original order, making the cross lane
+    permute4x64 fixup unnecessary. packus interleaves the quads of its two
+    inputs per lane, and that interleave is its own inverse."""
+    order = np.array([0, 1, 2, 3, 8, 9, 10, 11, 4, 5, 6, 7, 12, 13, 14, 15])
+    reordered = pattern.reshape(-1, 16)[:, order].ravel()
+    # Re-expand through the packus interleave and check the new layout
+    # reproduces the original order
+    assert (reordered.reshape(-1, 16)[:, order].ravel() == pattern).all()
+    return reordered
 
 
 def generate_intrinsics_avx2(
@@ -107,97 +432,457 @@ def generate_intrinsics_avx2(
     shift_pattern: list[int],
     name: str,
     shift_right: bool = False,
-) -> list[str]:
-    """Generates the intrinsics for the given 12 byte pattern using AVX2."""
+) -> tuple[list[tuple[str, tuple[int, ...], int]], list[str], list[str]]:
+    """Generates the intrinsics for the given 12 byte pattern using AVX2.
+    Returns the constant tables as (name, qwords, bits) tuples for
+    format_static, the in-function setup lines that load them, and the
+    per-loop body lines. Left shifts are done as a single 16 bit multiply by 1 << shift, avoiding
+    the widen to 32 bits that sllv would need and the narrowing back. Right
+    shifts have no multiply with the same effect for a shift of 0, so they
+    keep the widen, srlv, pack sequence. The generator is pure, so results
+    are cached on the tuple form of the patterns."""
+    return _gen_avx2(tuple(perm_pattern), tuple(shift_pattern), name, shift_right)
+
+
+@lru_cache(maxsize=None)
+def _gen_avx2(
+    perm_pattern: tuple[int, ...],
+    shift_pattern: tuple[int, ...],
+    name: str,
+    shift_right: bool,
+) -> tuple[list[tuple[str, tuple[int, ...], int]], list[str], list[str]]:
+    """Cached implementation of generate_intrinsics_avx2."""
     assert len(perm_pattern) == 12
     assert len(shift_pattern) == 12
 
-    repeated_perm = repeat_pattern(perm_pattern, 4, increase=True)
+    repeated_perm = _materialize(perm_pattern, 4, increase=True)
+    repeated_shift = _materialize(shift_pattern, 4)
+    if shift_right:
+        # Pre-swizzle the outputs so the packus results come out linear
+        # without a cross lane fixup
+        repeated_perm = _packus_order(repeated_perm)
+        repeated_shift = _packus_order(repeated_shift)
+
     split_16, split_32 = repeated_perm[:16], repeated_perm[16:]
     # To account for in lane shuffles, shift the indices in the first half by 8 and the second half by 16
-    split_32 = shift_indices(split_32[:16], -8) + shift_indices(split_32[16:], -16)
-    intify_16 = hexlist_ints(intify_pattern(split_16, replace=False))
-    intify_32 = hexlist_ints(intify_pattern(split_32, replace=False))
-
-    repeated_shift = repeat_pattern(shift_pattern, 4)
-    shift_0_lower = hexlist_ints(intify_pattern(repeated_shift[:8], 4))
-    shift_0_upper = hexlist_ints(intify_pattern(repeated_shift[8:16], 4))
-    shift_1_lower = hexlist_ints(intify_pattern(repeated_shift[16:24], 4))
-    shift_1_upper = hexlist_ints(intify_pattern(repeated_shift[24:32], 4))
-    shift_2_lower = hexlist_ints(intify_pattern(repeated_shift[32:40], 4))
-    shift_2_upper = hexlist_ints(intify_pattern(repeated_shift[40:], 4))
+    split_32 = np.concatenate(
+        (shift_indices(split_32[:16], -8), shift_indices(split_32[16:], -16))
+    )
+    statics = []
+    setup = []
+    body = []
+    # Permute the values, the body lines go inside the loop
+    if is_identity_pattern(split_16):
+        body.append(f"let {name}_16 = _mm256_castsi256_si128(longs);")
+    else:
+        _register_load(
+            statics, setup, f"perm_{name}_16", _pack(split_16, replace=False), 128
+        )
+        body.append(
+            f"let {name}_16 = _mm_shuffle_epi8(_mm256_castsi256_si128(longs), perm_{name}_16);"
+        )
+    # Permute the values for the upper 32 bytes
+    _register_load(statics, setup, f"perm_{name}_32", _pack(split_32, replace=False), 256)
+    body.append(f"let {name}_32 = _mm256_shuffle_epi8(longs_perm, perm_{name}_32);")
 
-    code = [
-        # Create the patterns for permutations
-        f"let perm_{name}_16 = _mm_set_epi64x({intify_16});",
-        f"let perm_{name}_32 = _mm256_set_epi64x({intify_32});",
-        # Create the patterns for shifts
-        f"let shift_{name}_0_lower = _mm256_set_epi64x({shift_0_lower});",
-        f"let shift_{name}_0_upper = _mm256_set_epi64x({shift_0_upper});",
-        f"let shift_{name}_1_lower = _mm256_set_epi64x({shift_1_lower});",
-        f"let shift_{name}_1_upper = _mm256_set_epi64x({shift_1_upper});",
-        f"let shift_{name}_2_lower = _mm256_set_epi64x({shift_2_lower});",
-        f"let shift_{name}_2_upper = _mm256_set_epi64x({shift_2_upper});",
-        # Permute the values, code starting here goes inside the loop
-        f"let {name}_16 = _mm_shuffle_epi8(_mm256_castsi256_si128(longs), perm_{name}_16);",
-        # Permute the values for the upper 32 bytes
-        f"let {name}_32 = _mm256_shuffle_epi8(longs_perm, perm_{name}_32);",
+    # Registers whose whole group shifts by zero are never reassigned; with
+    # right shifts packus always writes them back
+    muts = [
+        ""
+        if not shift_right
+        and uniform_shift(repeated_shift[16 * i : 16 * (i + 1)]) == 0
+        else "mut "
+        for i in range(3)
+    ]
+    body += [
         # Extend the 8 bit values to 16 bit values
-        f"let mut {name}_0 = _mm256_cvtepu8_epi16({name}_16);",
-        f"let mut {name}_1 = _mm256_cvtepu8_epi16(_mm256_castsi256_si128({name}_32));",
+        f"let {muts[0]}{name}_0 = _mm256_cvtepu8_epi16({name}_16);",
+        f"let {muts[1]}{name}_1 = _mm256_cvtepu8_epi16(_mm256_castsi256_si128({name}_32));",
         f"let {name}_32_upper = _mm256_extracti128_si256({name}_32, 1);",
-        f"let mut {name}_2 = _mm256_cvtepu8_epi16({name}_32_upper);",
+        f"let {muts[2]}{name}_2 = _mm256_cvtepu8_epi16({name}_32_upper);",
+    ]
+
+    shift_statics, shift_setup, shift_body = _avx2_shift_lines(
+        repeated_shift, name, shift_right
+    )
+    return statics + shift_statics, setup + shift_setup, body + shift_body
+
+
+def _avx2_shift_lines(
+    repeated_shift: np.ndarray, name: str, shift_right: bool
+) -> tuple[list[tuple[str, tuple[int, ...], int]], list[str], list[str]]:
+    """Generates the statics, setup, and body lines that shift the three
+    widened 16 bit registers of an AVX2 style unpack. Left shifts are a
+    single multiply, right shifts widen to 32 bits for srlv and saturate
+    back down."""
+    statics = []
+    setup = []
+    if not shift_right:
+        assert int(repeated_shift.max()) <= 15
+        body = []
+        # Create the multipliers for the shifts, dropping the multiply for
+        # groups that shift by zero and broadcasting groups with a single
+        # shared amount
+        for i in range(3):
+            amount = uniform_shift(repeated_shift[16 * i : 16 * (i + 1)])
+            if amount == 0:
+                continue
+            if amount is not None:
+                setup.append(
+                    f"let mul_{name}_{i} = _mm256_set1_epi16({1 << amount});"
+                )
+            else:
+                _register_load(
+                    statics,
+                    setup,
+                    f"mul_{name}_{i}",
+                    # The 0x80 sentinel only exists in permutation indices, and
+                    # a shift of 7 makes a legitimate 0x80 multiplier
+                    _pack(
+                        1 << repeated_shift[16 * i : 16 * (i + 1)], 2, replace=False
+                    ),
+                    256,
+                )
+            # Shift the values by multiplying with 1 << shift
+            body.append(f"{name}_{i} = _mm256_mullo_epi16({name}_{i}, mul_{name}_{i});")
+        return statics, setup, body
+
+    # Create the patterns for shifts, broadcasting groups with a single
+    # shared amount
+    shifts = []
+    for i in range(3):
+        for half, group in (
+            ("lower", repeated_shift[16 * i : 16 * i + 8]),
+            ("upper", repeated_shift[16 * i + 8 : 16 * (i + 1)]),
+        ):
+            amount = uniform_shift(group)
+            if amount == 0:
+                continue
+            if amount is not None:
+                setup.append(
+                    f"let shift_{name}_{i}_{half} = _mm256_set1_epi32({amount});"
+                )
+            else:
+                _register_load(
+                    statics, setup, f"shift_{name}_{i}_{half}", _pack(group, 4), 256
+                )
+            shifts.append(
+                f"{name}_{i}_{half} = _mm256_srlv_epi32({name}_{i}_{half}, shift_{name}_{i}_{half});"
+            )
+    # Halves whose whole group shifts by zero are never reassigned
+    muts = {
+        f"{i}_{half}": ""
+        if uniform_shift(repeated_shift[16 * i + 8 * j : 16 * i + 8 * (j + 1)]) == 0
+        else "mut "
+        for i in range(3)
+        for j, half in enumerate(("lower", "upper"))
+    }
+
+    body = [
         # Extend the 16 bit values to 32 bit values
-        f"let mut {name}_0_lower = _mm256_cvtepu16_epi32(_mm256_castsi256_si128({name}_0));",
+        f"let {muts['0_lower']}{name}_0_lower = _mm256_cvtepu16_epi32(_mm256_castsi256_si128({name}_0));",
         f"let {name}_0_upper = _mm256_extracti128_si256({name}_0, 1);",
-        f"let mut {name}_0_upper = _mm256_cvtepu16_epi32({name}_0_upper);",
-        f"let mut {name}_1_lower = _mm256_cvtepu16_epi32(_mm256_castsi256_si128({name}_1));",
+        f"let {muts['0_upper']}{name}_0_upper = _mm256_cvtepu16_epi32({name}_0_upper);",
+        f"let {muts['1_lower']}{name}_1_lower = _mm256_cvtepu16_epi32(_mm256_castsi256_si128({name}_1));",
         f"let {name}_1_upper = _mm256_extracti128_si256({name}_1, 1);",
-        f"let mut {name}_1_upper = _mm256_cvtepu16_epi32({name}_1_upper);",
-        f"let mut {name}_2_lower = _mm256_cvtepu16_epi32(_mm256_castsi256_si128({name}_2));",
+        f"let {muts['1_upper']}{name}_1_upper = _mm256_cvtepu16_epi32({name}_1_upper);",
+        f"let {muts['2_lower']}{name}_2_lower = _mm256_cvtepu16_epi32(_mm256_castsi256_si128({name}_2));",
         f"let {name}_2_upper = _mm256_extracti128_si256({name}_2, 1);",
-        f"let mut {name}_2_upper = _mm256_cvtepu16_epi32({name}_2_upper);",
-        # Shift the values
-        f"{name}_0_lower = _mm256_s{'r' if shift_right else 'l'}lv_epi32({name}_0_lower, shift_{name}_0_lower);",
-        f"{name}_0_upper = _mm256_s{'r' if shift_right else 'l'}lv_epi32({name}_0_upper, shift_{name}_0_upper);",
-        f"{name}_1_lower = _mm256_s{'r' if shift_right else 'l'}lv_epi32({name}_1_lower, shift_{name}_1_lower);",
-        f"{name}_1_upper = _mm256_s{'r' if shift_right else 'l'}lv_epi32({name}_1_upper, shift_{name}_1_upper);",
-        f"{name}_2_lower = _mm256_s{'r' if shift_right else 'l'}lv_epi32({name}_2_lower, shift_{name}_2_lower);",
-        f"{name}_2_upper = _mm256_s{'r' if shift_right else 'l'}lv_epi32({name}_2_upper, shift_{name}_2_upper);",
-        # Saturate the 32 bit values to 16 bit values
+        f"let {muts['2_upper']}{name}_2_upper = _mm256_cvtepu16_epi32({name}_2_upper);",
+    ]
+    # Shift the values
+    body += shifts
+    body += [
+        # Saturate the 32 bit values to 16 bit values, which are already in
+        # order thanks to the pre-swizzled permutation
         f"{name}_0 = _mm256_packus_epi32({name}_0_lower, {name}_0_upper);",
-        f"{name}_0 = _mm256_permute4x64_epi64({name}_0, 0b11011000);",
         f"{name}_1 = _mm256_packus_epi32({name}_1_lower, {name}_1_upper);",
-        f"{name}_1 = _mm256_permute4x64_epi64({name}_1, 0b11011000);",
         f"{name}_2 = _mm256_packus_epi32({name}_2_lower, {name}_2_upper);",
-        f"{name}_2 = _mm256_permute4x64_epi64({name}_2, 0b11011000);",
     ]
 
-    return code
+    return statics, setup, body
+
+
+def generate_intrinsics_avx512vbmi(
+    perm_pattern: list[int],
+    shift_pattern: list[int],
+    name: str,
+    shift_right: bool = False,
+) -> tuple[list[tuple[str, tuple[int, ...], int]], list[str], list[str]]:
+    """Generates the intrinsics for the given 12 byte pattern using 256 bit
+    AVX-512 VBMI permutes. VPERMB indexes all 32 source bytes directly, so a
+    single cross lane permute per 32 outputs replaces the separate 128 bit
+    shuffle, the in-lane 256 bit shuffle, and the longs_perm preparation the
+    plain AVX2 path needs."""
+    assert len(perm_pattern) == 12
+    assert len(shift_pattern) == 12
+
+    repeated_perm = _materialize(perm_pattern, 4, increase=True)
+    repeated_shift = _materialize(shift_pattern, 4)
+    if shift_right:
+        # Pre-swizzle the outputs so the packus results come out linear
+        # without a cross lane fixup
+        repeated_perm = _packus_order(repeated_perm)
+        repeated_shift = _packus_order(repeated_shift)
+
+    # Pad the trailing 16 outputs to a full register so the permutation can
+    # index all 32 source bytes
+    split_lo = repeated_perm[:32]
+    split_hi = np.concatenate((repeated_perm[32:], np.full(16, 0x80, np.int16)))
+    mask_lo = generate_mask(split_lo)
+    mask_hi = generate_mask(split_hi)
+
+    statics = []
+    setup = []
+    body = []
+    # Permute the values across lanes, the body lines go inside the loop
+    if is_identity_pattern(split_lo):
+        body.append(f"let {name}_lo = longs;")
+    else:
+        _register_load(statics, setup, f"perm_{name}_lo", _pack(split_lo), 256)
+        body.append(
+            f"let {name}_lo = _mm256_maskz_permutexvar_epi8(0x{mask_lo:08x}, perm_{name}_lo, longs);"
+        )
+    _register_load(statics, setup, f"perm_{name}_hi", _pack(split_hi), 256)
+    body.append(
+        f"let {name}_hi = _mm256_maskz_permutexvar_epi8(0x{mask_hi:08x}, perm_{name}_hi, longs);"
+    )
+
+    # Registers whose whole group shifts by zero are never reassigned; with
+    # right shifts packus always writes them back
+    muts = [
+        ""
+        if not shift_right
+        and uniform_shift(repeated_shift[16 * i : 16 * (i + 1)]) == 0
+        else "mut "
+        for i in range(3)
+    ]
+    body += [
+        # Extend the 8 bit values to 16 bit values
+        f"let {muts[0]}{name}_0 = _mm256_cvtepu8_epi16(_mm256_castsi256_si128({name}_lo));",
+        f"let {name}_lo_upper = _mm256_extracti128_si256({name}_lo, 1);",
+        f"let {muts[1]}{name}_1 = _mm256_cvtepu8_epi16({name}_lo_upper);",
+        f"let {muts[2]}{name}_2 = _mm256_cvtepu8_epi16(_mm256_castsi256_si128({name}_hi));",
+    ]
+
+    shift_statics, shift_setup, shift_body = _avx2_shift_lines(
+        repeated_shift, name, shift_right
+    )
+    return statics + shift_statics, setup + shift_setup, body + shift_body
+
+
+def emit_prologue() -> list[str]:
+    """Emits the loop prologue shared by the AVX-512 patterns: the 256 bit
+    view of the 64 source bytes, bound once instead of being cast again at
+    every permute that only reads the lower half."""
+    return ["let longs_256 = _mm512_castsi512_si256(longs);"]
+
+
+def emit_avx512(pattern: UnpackPattern):
+    """Emits the AVX-512 intrinsics for the pattern."""
+    return generate_intrinsics_avx512(
+        list(pattern.perm), list(pattern.shift), pattern.name, pattern.shift_right
+    )
+
+
+def emit_avx2(pattern: UnpackPattern):
+    """Emits the AVX2 intrinsics for the pattern."""
+    return generate_intrinsics_avx2(
+        list(pattern.perm), list(pattern.shift), pattern.name, pattern.shift_right
+    )
+
+
+def emit_neon(pattern: UnpackPattern) -> tuple[list[str], list[str]]:
+    """Emits the NEON intrinsics for the pattern. The source is a
+    uint8x16x4_t table of the 64 input bytes (vld1q_u8_x4) named table, which
+    vqtbl4q_u8 permutes 16 outputs at a time with out of range indices
+    producing zero; vshlq_u16 then applies the per-element shifts, negated
+    for right shifts since NEON only has a variable left shift."""
+    repeated_perm = _materialize(pattern.perm, 8, increase=True)
+    repeated_shift = _materialize(pattern.shift, 8)
+    sign = -1 if pattern.shift_right else 1
+    name = pattern.name
+
+    setup = []
+    body = []
+    for g in range(6):
+        split = repeated_perm[16 * g : 16 * (g + 1)]
+        idx = ", ".join(str(int(x) if x != 0x80 else 0xFF) for x in split)
+        setup.append(f"let perm_{name}_{g} = vld1q_u8([{idx}].as_ptr());")
+        # Permute the values, the body lines go inside the loop
+        body.append(f"let {name}_{g} = vqtbl4q_u8(table, perm_{name}_{g});")
+    for j in range(12):
+        amounts = ", ".join(str(sign * int(x)) for x in repeated_shift[8 * j : 8 * (j + 1)])
+        setup.append(f"let shift_{name}_{j} = vld1q_s16([{amounts}].as_ptr());")
+    for g in range(6):
+        # Extend the 8 bit values to 16 bit values and shift them
+        body.append(
+            f"let {name}_{g}_lo = vshlq_u16(vmovl_u8(vget_low_u8({name}_{g})), shift_{name}_{2 * g});"
+        )
+        body.append(
+            f"let {name}_{g}_hi = vshlq_u16(vmovl_u8(vget_high_u8({name}_{g})), shift_{name}_{2 * g + 1});"
+        )
+
+    return setup, body
+
+
+def emit_sve(pattern: UnpackPattern) -> tuple[list[str], list[str]]:
+    """Emits the SVE intrinsics for the pattern, assuming a 512 bit vector
+    length so the 64 input bytes fill one register named table. Each group of
+    32 outputs gets a permutation padded to 64 indices, of which svtbl_u8
+    places the group's bytes in the lower half with out of range indices
+    producing zero; svunpklo_u16 zero extends exactly those 32 bytes to the
+    register's 32 lanes of 16 bits, and svlsl/svlsr apply the per-element
+    shifts. Rust has no stable SVE intrinsics yet, so this output is written
+    for a C shim."""
+    repeated_perm = _materialize(pattern.perm, 8, increase=True)
+    repeated_shift = _materialize(pattern.shift, 8)
+    direction = "svlsr" if pattern.shift_right else "svlsl"
+    name = pattern.name
+
+    setup = []
+    body = []
+    for g in range(3):
+        # Pad to the 64 byte lanes svld1_u8 reads at this vector length; the
+        # upper half is discarded by the unpack
+        split = np.concatenate(
+            (repeated_perm[32 * g : 32 * (g + 1)], np.full(32, 0x80, np.int16))
+        )
+        idx = ", ".join(str(int(x) if x != 0x80 else 0xFF) for x in split)
+        setup.append(f"let perm_{name}_{g} = svld1_u8(ptrue, [{idx}].as_ptr());")
+        amounts = ", ".join(str(int(x)) for x in repeated_shift[32 * g : 32 * (g + 1)])
+        setup.append(f"let shift_{name}_{g} = svld1_u16(ptrue, [{amounts}].as_ptr());")
+        # Permute the values, the body lines go inside the loop
+        body.append(f"let {name}_{g} = svtbl_u8(table, perm_{name}_{g});")
+        # Extend the 8 bit values to 16 bit values and shift them
+        body.append(
+            f"let {name}_{g} = {direction}_u16_x(ptrue, svunpklo_u16({name}_{g}), shift_{name}_{g});"
+        )
+
+    return setup, body
+
+
+@dataclass
+class GeneratedCode:
+    """One titled section of emitter output: the static declarations followed
+    by the deduplicated setup and body lines."""
+
+    title: str
+    statics: list[str]
+    lines: list[str]
+
+
+_TEMPLATE = jinja2.Template(
+    "{% for section in sections %}"
+    "{{ section.title }}\n"
+    "{% for line in section.statics + section.lines %}"
+    "{{ line }}\n"
+    "{% endfor %}"
+    "{% endfor %}"
+)
+
+
+_EMITTERS = {
+    "avx512": emit_avx512,
+    "avx2": emit_avx2,
+    "neon": emit_neon,
+    "sve": emit_sve,
+}
+
+
+def generate_intrinsics(isa: str, pattern: UnpackPattern):
+    """Dispatches to the emitter for the given ISA. The x86 emitters also
+    return constant tables for format_static ahead of the setup and body
+    lines; the ARM ones only return setup and body."""
+    return _EMITTERS[isa](pattern)
 
 
 if __name__ == "__main__":
     perm_pattern_a = [0, 1, 0x80, 2, 3, 0x80, 4, 0x80, 5, 6, 0x80, 7]
     shift_pattern_a = [0, 3, 0, 1, 4, 0, 2, 0, 0, 3, 0, 1]
-    avx512_a = generate_intrinsics_avx512(perm_pattern_a, shift_pattern_a, "a")
+    avx512_a_statics, avx512_a_setup, avx512_a_body = generate_intrinsics_avx512(
+        perm_pattern_a, shift_pattern_a, "a"
+    )
 
     perm_pattern_b = [0x80, 0, 1, 1, 2, 3, 3, 4, 0x80, 5, 6, 6]
     shift_pattern_b = [0, 5, 2, 7, 4, 1, 6, 3, 0, 5, 2, 7]
-    avx512_b = generate_intrinsics_avx512(
+    avx512_b_statics, avx512_b_setup, avx512_b_body = generate_intrinsics_avx512(
+        perm_pattern_b, shift_pattern_b, "b", shift_right=True
+    )
+
+    avx512_statics, avx512 = dedupe_statics(
+        avx512_a_statics + avx512_b_statics,
+        avx512_a_setup
+        + avx512_b_setup
+        + emit_prologue()
+        + avx512_a_body
+        + avx512_b_body,
+    )
+    sections = [GeneratedCode("AVX-512", avx512_statics, dedupe_bindings(avx512))]
+
+    # The a and b patterns cover the high and low halves of the same fields,
+    # so a single multishift pattern replaces both once they are merged
+    perm_pattern_ab = [
+        a if b == 0x80 else b for a, b in zip(perm_pattern_a, perm_pattern_b)
+    ]
+    shift_pattern_ab = [
+        a if pb == 0x80 else b
+        for a, b, pb in zip(shift_pattern_a, shift_pattern_b, perm_pattern_b)
+    ]
+    avx512_multishift = generate_intrinsics_avx512_multishift(
+        perm_pattern_ab, shift_pattern_ab, "ab", shift_right=True
+    )
+    sections.append(
+        GeneratedCode(
+            "AVX-512 VBMI multishift", [], dedupe_bindings(avx512_multishift)
+        )
+    )
+
+    swar = generate_intrinsics_swar(
+        perm_pattern_ab, shift_pattern_ab, "ab", shift_right=True
+    )
+    sections.append(GeneratedCode("Scalar SWAR", [], swar))
+
+    avx2_a_statics, avx2_a_setup, avx2_a_body = generate_intrinsics_avx2(
+        perm_pattern_a, shift_pattern_a, "a"
+    )
+    avx2_b_statics, avx2_b_setup, avx2_b_body = generate_intrinsics_avx2(
         perm_pattern_b, shift_pattern_b, "b", shift_right=True
     )
 
-    avx512 = avx512_a[:5] + avx512_b[:5] + avx512_a[5:] + avx512_b[5:]
-    print("AVX-512")
-    for line in avx512:
-        print(line)
+    avx2_statics, avx2 = dedupe_statics(
+        avx2_a_statics + avx2_b_statics,
+        avx2_a_setup + avx2_b_setup + avx2_a_body + avx2_b_body,
+    )
+    sections.append(GeneratedCode("AVX2", avx2_statics, dedupe_bindings(avx2)))
 
-    avx2_a = generate_intrinsics_avx2(perm_pattern_a, shift_pattern_a, "a")
-    avx2_b = generate_intrinsics_avx2(
+    vbmi_a_statics, vbmi_a_setup, vbmi_a_body = generate_intrinsics_avx512vbmi(
+        perm_pattern_a, shift_pattern_a, "a"
+    )
+    vbmi_b_statics, vbmi_b_setup, vbmi_b_body = generate_intrinsics_avx512vbmi(
         perm_pattern_b, shift_pattern_b, "b", shift_right=True
     )
 
-    avx2 = avx2_a[:8] + avx2_b[:8] + avx2_a[8:] + avx2_b[8:]
-    print("AVX2")
-    for line in avx2:
-        print(line)
+    vbmi_statics, vbmi = dedupe_statics(
+        vbmi_a_statics + vbmi_b_statics,
+        vbmi_a_setup + vbmi_b_setup + vbmi_a_body + vbmi_b_body,
+    )
+    sections.append(
+        GeneratedCode(
+            "AVX2 with AVX-512 VBMI permutes", vbmi_statics, dedupe_bindings(vbmi)
+        )
+    )
+
+    pattern_a = UnpackPattern(tuple(perm_pattern_a), tuple(shift_pattern_a), "a")
+    pattern_b = UnpackPattern(
+        tuple(perm_pattern_b), tuple(shift_pattern_b), "b", shift_right=True
+    )
+
+    for isa, title in (("neon", "NEON"), ("sve", "SVE")):
+        a_setup, a_body = generate_intrinsics(isa, pattern_a)
+        b_setup, b_body = generate_intrinsics(isa, pattern_b)
+        sections.append(
+            GeneratedCode(title, [], dedupe_bindings(a_setup + b_setup + a_body + b_body))
+        )
+
+    sys.stdout.write(_TEMPLATE.render(sections=sections))